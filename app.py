@@ -1,16 +1,21 @@
 # app.py
 import os
-from flask import Flask, request, jsonify, send_from_directory
+import io
+import shutil
+from flask import Flask, request, jsonify, send_file, send_from_directory
+from werkzeug.security import safe_join
 from flask_cors import CORS
 import fitz # PyMuPDF
 import tempfile
 import logging
+import time
 from datetime import datetime
 import uuid
 from docx import Document
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import re
+import zlib
 
 app = Flask(__name__, static_folder='static')
 
@@ -29,170 +34,331 @@ CORS(app, resources={
 })
 
 # --- File Upload Configuration ---
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+# A dedicated directory, so the stale-output sweep only ever touches files this app created
+app.config['UPLOAD_FOLDER'] = os.path.join(tempfile.gettempdir(), 'pdf-highlight-extractor')
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024 # 64 MB file size limit
+# In 'cropped_highlight' mode, pages with this many highlights are rendered once and cropped, instead of per highlight
+app.config['PAGE_RENDER_MIN_HIGHLIGHTS'] = 10
+app.config['DOCX_IMAGE_WIDTH_INCHES'] = 6 # Width complex-text images are placed at in the DOCX
+app.config['DOCX_IMAGE_DPI'] = 150 # Target resolution of those images at that width
+# 'png' (lossless) or 'jpeg' (faster encode, larger for text); 'jpg' and any letter case are accepted
+docx_image_format = os.environ.get('DOCX_IMAGE_FORMAT', 'png').strip().lower()
+docx_image_format = {'jpg': 'jpeg'}.get(docx_image_format, docx_image_format)
+if docx_image_format not in ('png', 'jpeg'):
+    raise ValueError(f"Unsupported DOCX_IMAGE_FORMAT {docx_image_format!r}: use 'png' or 'jpeg'.")
+app.config['DOCX_IMAGE_FORMAT'] = docx_image_format
+app.config['DOCX_IMAGE_JPEG_QUALITY'] = 85
+# Opt-in: encode DOCX highlight images in grayscale (a third of the samples). This also greys out the highlight colour
+app.config['DOCX_IMAGE_GRAYSCALE'] = os.environ.get('DOCX_IMAGE_GRAYSCALE', '0') == '1'
+app.config['IN_MEMORY_UPLOAD_LIMIT'] = 16 * 1024 * 1024 # Larger uploads are spooled to a temp file instead
+app.config['OUTPUT_FILE_TTL'] = 60 * 60 # Generated files not downloaded within an hour are removed
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 logging.info(f"Upload folder set to: {app.config['UPLOAD_FOLDER']}")
 
-# --- PDF Highlight Extraction Function ---
-def extract_highlights_from_pdf(pdf_path):
+# --- Text Cleaning and Classification Tables ---
+# Control characters (except tabs, newlines, etc.) and null bytes that are invalid in DOCX XML.
+_CTRL_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+# Mathematical operators (≤ ≥ ≠ ≈ ∞ ∫ ∑ ∏ ∂ ∇ ...), Greek letters, and the micro/epsilon
+# variants that fall outside those two blocks.
+_COMPLEX_CHARS = frozenset(map(chr, range(0x2200, 0x2300))) | frozenset(map(chr, range(0x0391, 0x03CA))) | frozenset("µϵ")
+
+# --- Pixmap Cropping Helper ---
+def crop_pixmap(page_pixmap, rect, matrix):
+    """
+    Copies the area of a page rectangle out of an already-rendered page pixmap.
+    This is a plain sample copy, so a page is rasterized once no matter how many highlights it has.
+    """
+    irect = (fitz.Rect(rect) * matrix).irect & page_pixmap.irect
+    cropped = fitz.Pixmap(page_pixmap.colorspace, irect, page_pixmap.alpha)
+    cropped.copy(page_pixmap, irect)
+    return cropped
+
+# --- Highlighted Text Helper ---
+def text_in_rect_from_words(words, rect):
+    """
+    Joins the words (from page.get_text("words")) whose centre lies inside the rectangle,
+    one line of text per line in the PDF.
     """
-    Extracts highlighted text along with their page numbers and bounding boxes
-    from a PDF document.
+    lines = {}
+    for x0, y0, x1, y1, word, block_no, line_no, _ in words:
+        if rect.x0 <= (x0 + x1) / 2 <= rect.x1 and rect.y0 <= (y0 + y1) / 2 <= rect.y1:
+            lines.setdefault((block_no, line_no), []).append(word)
+    return "\n".join(" ".join(line_words) for line_words in lines.values())
+
+# --- Single-Pass PDF Processing ---
+def render_highlight_area(page, rendered_page, rect, matrix):
+    """
+    Returns the pixmap of a highlighted area: cut out of the page render when there is one,
+    otherwise rendered on its own with a clip, which is much cheaper than a full page for a few highlights.
+    Returns None if the area fails to render.
     """
-    highlights = []
     try:
-        doc = fitz.open(pdf_path)
-        for page_num, page in enumerate(doc):
-            annotations = page.annots()
-            for annot in annotations:
-                if annot.type[0] == fitz.PDF_ANNOT_HIGHLIGHT:
-                    rect = annot.rect
-                    if rect and not rect.is_empty:
-                        text_in_rect = page.get_text(clip=rect)
-                        if text_in_rect:
-                            full_highlighted_text = text_in_rect.strip()
-                            highlights.append({
-                                "text": full_highlighted_text,
-                                "page": page_num + 1,
-                                "rect": list(rect)
-                            })
-        doc.close()
-        logging.info(f"Successfully extracted {len(highlights)} highlights from {pdf_path}")
-    except fitz.FileNotFoundError:
-        logging.error(f"PDF file not found at '{pdf_path}'")
-        return []
+        if rendered_page is not None:
+            return crop_pixmap(rendered_page, rect, matrix)
+        return page.get_pixmap(matrix=matrix, clip=rect)
     except Exception as e:
-        logging.error(f"Error during PDF processing for extraction: {e}")
-        return []
-    return highlights
+        logging.exception(f"Error rendering highlight on page {page.number + 1}: {e}")
+        return None
+
+def render_docx_image(page, rendered_page, cropped_pixmap, rect, matrix):
+    """
+    Returns the pixmap of a complex-text highlight for the DOCX, at the scale given by docx_image_scale.
+    Narrow highlights that need more than the page resolution are rendered on their own at that scale;
+    the others are downsampled from the crop at the page resolution. Returns None if the area fails to render.
+    """
+    scale = docx_image_scale(rect)
+    if scale > matrix.a:
+        return render_highlight_area(page, None, rect, fitz.Matrix(scale, scale))
+    if cropped_pixmap is None:
+        cropped_pixmap = render_highlight_area(page, rendered_page, rect, matrix)
+    if cropped_pixmap is None or scale == matrix.a:
+        return cropped_pixmap
+    # Whole-pixel sizes: fractional ones make MuPDF add an alpha channel with a faded edge
+    target_width = max(1, round(cropped_pixmap.width * scale / matrix.a))
+    target_height = max(1, round(cropped_pixmap.height * scale / matrix.a))
+    return fitz.Pixmap(cropped_pixmap, target_width, target_height)
+
+def process_pdf(doc, mode):
+    """
+    Walks an already-open PDF document once. For every page with highlights it extracts the
+    highlighted text and renders the pixmaps needed by the PDF and DOCX outputs while the page is loaded.
+    Yields (highlight, is_complex, full_page_pixmap, cropped_pixmap, image_pixmap) tuples:
+    - is_complex tells whether the highlighted text is complex, so the DOCX shows it as an image.
+    - full_page_pixmap is set on the first highlight of each page in 'full_page' mode, otherwise None.
+    - cropped_pixmap is set in 'cropped_highlight' mode, image_pixmap (the DOCX image) when the text
+      is complex, as long as the highlight overlaps the visible page.
+    A page is rendered in full at most once: in 'full_page' mode, or when it has at least
+    PAGE_RENDER_MIN_HIGHLIGHTS highlights, and the crops are then cut out of that render.
+    Otherwise each crop is rendered on its own, as are DOCX images that need a higher resolution.
+    If rendering fails, the highlights are still yielded, with None for the pixmaps that are missing.
+    Any other error (reading the annotations or text) propagates, rather than silently cutting the output short.
+    Rendering stays on the calling thread, as PyMuPDF does not support multithreaded use of a document.
+    """
+    matrix = fitz.Matrix(2, 2)
+    highlight_count = 0
+    for page_num, page in enumerate(doc):
+        # Most pages of long documents carry no annotations at all; skip them outright
+        if not page.first_annot:
+            continue
+        highlight_annots = list(page.annots(types=[fitz.PDF_ANNOT_HIGHLIGHT]))
+        render_page = mode == 'full_page' or len(highlight_annots) >= app.config['PAGE_RENDER_MIN_HIGHLIGHTS']
+        words = None
+        rendered_page = None
+        render_failed = False
+        full_page_pixmap = None
+        for annot in highlight_annots:
+            rect = annot.rect
+            if rect and not rect.is_empty:
+                # Extract the page's words once and match every highlight against them
+                if words is None:
+                    words = page.get_text("words")
+                full_highlighted_text = text_in_rect_from_words(words, rect).strip()
+                if full_highlighted_text:
+                    highlight = {
+                        "text": full_highlighted_text,
+                        "page": page_num + 1,
+                        "rect": list(rect)
+                    }
+
+                    is_complex = is_complex_text(sanitize_text(full_highlighted_text))
+                    # Annotation artifacts that don't overlap the visible page have nothing to crop
+                    visible = not (rect & page.rect).is_empty
+                    needs_crop = visible and (mode == 'cropped_highlight' or is_complex)
+                    if render_page and rendered_page is None and not render_failed and (mode == 'full_page' or needs_crop):
+                        try:
+                            rendered_page = page.get_pixmap(matrix=matrix)
+                        except Exception as e:
+                            # Keep extracting: the outputs note the missing screenshots instead
+                            logging.exception(f"Error rendering page {page_num + 1}: {e}")
+                            render_failed = True
+
+                    page_pixmap = None
+                    if mode == 'full_page' and full_page_pixmap is None:
+                        full_page_pixmap = page_pixmap = rendered_page
+
+                    cropped_pixmap = None
+                    if mode == 'cropped_highlight' and needs_crop and not render_failed:
+                        cropped_pixmap = render_highlight_area(page, rendered_page, rect, matrix)
+                    image_pixmap = None
+                    if is_complex and needs_crop and not render_failed:
+                        image_pixmap = render_docx_image(page, rendered_page, cropped_pixmap, rect, matrix)
+
+                    highlight_count += 1
+                    yield highlight, is_complex, page_pixmap, cropped_pixmap, image_pixmap
+    logging.info(f"Successfully extracted {highlight_count} highlights from {doc.name or 'uploaded PDF'}")
+
+# --- Image Insertion Helper ---
+def insert_compressed_image(page, rect, pixmap):
+    """
+    Inserts a pixmap into an output PDF page and deflates its image stream straight away.
+    Otherwise the output document keeps the raw samples of every inserted image in memory until it is saved.
+    Uses the fastest zlib level: MuPDF's default level is several times slower on page-sized renders
+    for little size gain.
+    """
+    xref = page.insert_image(rect, pixmap=pixmap)
+    output_doc = page.parent
+    # Identical pixmaps come back as the same, already deflated image
+    if output_doc.xref_get_key(xref, "Filter")[0] != "null":
+        return
+    output_doc.update_stream(xref, zlib.compress(output_doc.xref_stream(xref), 1), compress=False)
+    output_doc.xref_set_key(xref, "Filter", "/FlateDecode")
 
 # --- Function to Generate PDF from Highlight Screenshots ---
-def generate_pdf_from_highlight_screenshots(original_pdf_path, highlights, output_pdf_path, mode):
+def generate_pdf_from_highlight_screenshots(records, output_pdf_path, mode):
     """
-    Generates a new PDF document based on the specified mode.
+    Generates a new PDF document based on the specified mode, from the
+    (highlight, is_complex, full_page_pixmap, cropped_pixmap, image_pixmap) records yielded by process_pdf.
+    The records are laid out as they are produced and each image is compressed as soon as it is inserted,
+    so only the page being processed is held in memory uncompressed.
     Mode 'full_page': Takes a screenshot of the entire page with the highlight.
     Mode 'cropped_highlight': Takes a screenshot of just the highlighted area.
     """
     output_doc = fitz.open()
-    
-    if not highlights:
-        page = output_doc.new_page()
-        page.insert_text((50, 50), "No highlights found in the uploaded document.", fontsize=12)
-        logging.info("Generated PDF with 'No highlights found' message.")
-    else:
-        try:
-            original_doc = fitz.open(original_pdf_path)
+    highlight_count = 0
+    layout_failed = False
+
+    margin = 50
+    max_page_width = 595
+    max_page_height = 842
+    screenshot_pages = set() # 'full_page': original pages already added
+    current_page = None # 'cropped_highlight': output page being filled, and the position on it
+    y_offset = margin
+
+    for highlight, _, pixmap, cropped_pixmap, _ in records:
+        highlight_count += 1
+        if layout_failed:
+            # Keep consuming the records, so every highlight still reaches the rest of the pipeline
+            continue
 
+        try:
             if mode == 'full_page':
-                unique_original_page_nums = sorted(list(set(item['page'] for item in highlights)))
-                for original_page_num in unique_original_page_nums:
-                    original_page = original_doc.load_page(original_page_num - 1)
-                    matrix = fitz.Matrix(2, 2) 
-                    pixmap = original_page.get_pixmap(matrix=matrix)
-                    
-                    new_page = output_doc.new_page(width=595, height=842)
-                    y_offset = 50
-                    margin = 50
-                    
-                    title_text = f"Original Page {original_page_num} (with highlights):"
-                    new_page.insert_text((margin, y_offset), title_text, fontsize=14)
-                    y_offset += 25
-
-                    img_width = pixmap.width
-                    img_height = pixmap.height
-                    max_img_width = new_page.rect.width - 2 * margin
+                original_page_num = highlight['page']
+                if original_page_num in screenshot_pages:
+                    continue
+                screenshot_pages.add(original_page_num)
+                if pixmap is None:
+                    # The page failed to render in process_pdf
+                    new_page = output_doc.new_page(width=max_page_width, height=max_page_height)
+                    new_page.insert_text((margin, margin), f"Original Page {original_page_num}: screenshot not available.", fontsize=14)
+                    logging.warning(f"No screenshot available for original page {original_page_num}")
+                    continue
+
+                new_page = output_doc.new_page(width=max_page_width, height=max_page_height)
+                y_offset = margin
+                
+                title_text = f"Original Page {original_page_num} (with highlights):"
+                new_page.insert_text((margin, y_offset), title_text, fontsize=14)
+                y_offset += 25
+
+                img_width = pixmap.width
+                img_height = pixmap.height
+                max_img_width = new_page.rect.width - 2 * margin
+                max_img_height_on_current_page = new_page.rect.height - y_offset - margin
+                scale_x = max_img_width / img_width
+                scale_y = max_img_height_on_current_page / img_height
+                scale_factor = min(scale_x, scale_y)
+                scaled_img_width = img_width * scale_factor
+                scaled_img_height = img_height * scale_factor
+
+                if scaled_img_height > max_img_height_on_current_page:
+                    new_page = output_doc.new_page(width=max_page_width, height=max_page_height)
+                    y_offset = margin
+                    new_page.insert_text((margin, y_offset), f"(Continued from Original Page {original_page_num})", fontsize=10)
+                    y_offset += 20
                     max_img_height_on_current_page = new_page.rect.height - y_offset - margin
-                    scale_x = max_img_width / img_width
                     scale_y = max_img_height_on_current_page / img_height
                     scale_factor = min(scale_x, scale_y)
                     scaled_img_width = img_width * scale_factor
                     scaled_img_height = img_height * scale_factor
 
-                    if scaled_img_height > max_img_height_on_current_page:
-                        new_page = output_doc.new_page(width=595, height=842)
-                        y_offset = margin
-                        new_page.insert_text((margin, y_offset), f"(Continued from Original Page {original_page_num})", fontsize=10)
-                        y_offset += 20
-                        max_img_height_on_current_page = new_page.rect.height - y_offset - margin
-                        scale_y = max_img_height_on_current_page / img_height
-                        scale_factor = min(scale_x, scale_y)
-                        scaled_img_width = img_width * scale_factor
-                        scaled_img_height = img_height * scale_factor
-
-                    img_x = margin + (max_img_width - scaled_img_width) / 2
-                    img_y = y_offset
+                img_x = margin + (max_img_width - scaled_img_width) / 2
+                img_y = y_offset
 
-                    target_rect = fitz.Rect(img_x, img_y, img_x + scaled_img_width, img_y + scaled_img_height)
-                    new_page.insert_image(target_rect, pixmap=pixmap)
-                    logging.info(f"Inserted full page screenshot for original page {original_page_num}")
+                target_rect = fitz.Rect(img_x, img_y, img_x + scaled_img_width, img_y + scaled_img_height)
+                insert_compressed_image(new_page, target_rect, pixmap)
+                logging.info(f"Inserted full page screenshot for original page {original_page_num}")
 
             elif mode == 'cropped_highlight':
-                y_offset = 50
-                margin = 50
-                max_page_width = 595
-                max_page_height = 842
-                current_page = output_doc.new_page(width=max_page_width, height=max_page_height)
-                
-                for highlight in highlights:
-                    page_num = highlight['page']
-                    rect_coords = highlight['rect']
-                    rect = fitz.Rect(rect_coords)
-                    
-                    original_page = original_doc.load_page(page_num - 1)
-                    matrix = fitz.Matrix(2, 2)
-                    pixmap = original_page.get_pixmap(matrix=matrix, clip=rect)
-
-                    # Calculate image dimensions and scaling
-                    img_width = pixmap.width
-                    img_height = pixmap.height
-                    max_img_width = current_page.rect.width - 2 * margin
-                    
-                    scale_x = max_img_width / img_width
-                    scale_factor = min(scale_x, 1.0) # Do not upscale
-                    
-                    scaled_img_width = img_width * scale_factor
-                    scaled_img_height = img_height * scale_factor
+                page_num = highlight['page']
+                if current_page is None:
+                    current_page = output_doc.new_page(width=max_page_width, height=max_page_height)
 
-                    # Check if the image will fit on the current page
-                    if y_offset + scaled_img_height + margin > max_page_height:
+                if cropped_pixmap is None:
+                    # The page failed to render, or the highlight has no visible area
+                    if y_offset + 15 + margin > max_page_height:
                         current_page = output_doc.new_page(width=max_page_width, height=max_page_height)
                         y_offset = margin
-                    
-                    # Add title for the highlight
-                    title_text = f"Page {page_num} Highlight:"
-                    current_page.insert_text((margin, y_offset), title_text, fontsize=10)
-                    y_offset += 15
-
-                    # Insert the image
-                    img_x = margin
-                    img_y = y_offset
-                    target_rect = fitz.Rect(img_x, img_y, img_x + scaled_img_width, img_y + scaled_img_height)
-                    current_page.insert_image(target_rect, pixmap=pixmap)
-                    
-                    y_offset += scaled_img_height + 25 # Move down for the next highlight
-                    logging.info(f"Inserted cropped highlight screenshot for page {page_num}")
-            
-            original_doc.close()
+                    current_page.insert_text((margin, y_offset), f"Page {page_num} Highlight: screenshot not available.", fontsize=10)
+                    y_offset += 25
+                    logging.warning(f"No screenshot available for highlight on page {page_num}")
+                    continue
+
+                # Calculate image dimensions and scaling
+                img_width = cropped_pixmap.width
+                img_height = cropped_pixmap.height
+                max_img_width = current_page.rect.width - 2 * margin
+                
+                scale_x = max_img_width / img_width
+                scale_factor = min(scale_x, 1.0) # Do not upscale
+                
+                scaled_img_width = img_width * scale_factor
+                scaled_img_height = img_height * scale_factor
+
+                # Check if the image will fit on the current page
+                if y_offset + scaled_img_height + margin > max_page_height:
+                    current_page = output_doc.new_page(width=max_page_width, height=max_page_height)
+                    y_offset = margin
+                
+                # Add title for the highlight
+                title_text = f"Page {page_num} Highlight:"
+                current_page.insert_text((margin, y_offset), title_text, fontsize=10)
+                y_offset += 15
+
+                # Insert the image
+                img_x = margin
+                img_y = y_offset
+                target_rect = fitz.Rect(img_x, img_y, img_x + scaled_img_width, img_y + scaled_img_height)
+                insert_compressed_image(current_page, target_rect, cropped_pixmap)
+                
+                y_offset += scaled_img_height + 25 # Move down for the next highlight
+                logging.info(f"Inserted cropped highlight screenshot for page {page_num}")
 
         except Exception as e:
             logging.exception(f"Error generating PDF from screenshots: {e}")
-            output_doc = fitz.open()
-            page = output_doc.new_page()
-            page.insert_text((50, 50), "Error generating visual highlights. Please try again or check the original PDF.", fontsize=12)
+            layout_failed = True
 
-    output_doc.save(output_pdf_path)
+    if layout_failed:
+        output_doc.close()
+        output_doc = fitz.open()
+        page = output_doc.new_page()
+        page.insert_text((50, 50), "Error generating visual highlights. Please try again or check the original PDF.", fontsize=12)
+    elif not highlight_count:
+        page = output_doc.new_page()
+        page.insert_text((50, 50), "No highlights found in the uploaded document.", fontsize=12)
+        logging.info("Generated PDF with 'No highlights found' message.")
+
+    # Deflate whatever is still uncompressed (page content streams); the images already are
+    output_doc.save(output_pdf_path, deflate=True)
     output_doc.close()
     logging.info(f"Generated output PDF at: {output_pdf_path}")
 
+def collect_docx_records(records, docx_records):
+    """
+    Passes the records yielded by process_pdf through unchanged, appending the
+    (highlight, is_complex, image_pixmap) triples generate_docx_from_highlights needs to docx_records.
+    Page renders and the PDF crops are not kept.
+    """
+    for record in records:
+        highlight, is_complex, _, _, image_pixmap = record
+        docx_records.append((highlight, is_complex, image_pixmap))
+        yield record
+
 def sanitize_text(text):
     """
     Removes invalid characters that can cause issues when writing to XML-based formats like DOCX.
     """
-    # Remove control characters (except for common ones like tabs, newlines, etc.)
-    # and any null bytes.
-    return re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]', '', text)
+    return _CTRL_RE.sub('', text)
 
 # --- NEW Function to detect complex text ---
 def is_complex_text(text):
@@ -200,75 +366,95 @@ def is_complex_text(text):
     Checks if a string contains characters that are likely part of a formula or complex symbol.
     This is a simple heuristic and might need to be refined.
     """
-    # Regex to detect common mathematical symbols, Greek letters, or non-ASCII characters that might
-    # not render well as plain text in DOCX.
-    complex_pattern = re.compile(r'[≤≥≠≈∞∫∑∏µΔΩ∂∇θλπρτφχψζηξςαβγδϵζηθικλμνξοπρσςτυφχψω]|[\u2200-\u22FF]|[\u0391-\u03C9]')
-    return bool(complex_pattern.search(text))
+    # Every complex character is non-ASCII, so plain ASCII text can skip the set lookup entirely.
+    return not text.isascii() and not _COMPLEX_CHARS.isdisjoint(text)
+
+# --- DOCX Image Resolution ---
+def docx_image_scale(rect):
+    """
+    Scale (pixels per PDF point) of the DOCX image of a highlight: the one that gives about DOCX_IMAGE_DPI
+    once the image is stretched to DOCX_IMAGE_WIDTH_INCHES, clamped to [1.5, 3.0].
+    Anything beyond that is thrown away when the DOCX scales the picture.
+    """
+    highlight_width_inches = fitz.Rect(rect).width / 72
+    scale = app.config['DOCX_IMAGE_DPI'] / 72 * (app.config['DOCX_IMAGE_WIDTH_INCHES'] / highlight_width_inches)
+    return min(max(scale, 1.5), 3.0)
 
 # --- NEW Function to create an image from a highlight ---
-def create_highlight_image(pdf_path, page_num, rect_coords):
+def create_highlight_image(pixmap, page_num):
     """
-    Creates a high-resolution image of a specific highlighted area.
-    Returns the path to the temporary image file.
+    Encodes the rendered pixmap of a highlighted area (see render_docx_image) as an image.
+    With DOCX_IMAGE_GRAYSCALE enabled the image is converted to gray before encoding.
+    Returns an in-memory PNG (or JPEG, see DOCX_IMAGE_FORMAT) buffer that can be passed straight to python-docx.
     """
-    temp_image_path = None
     try:
-        doc = fitz.open(pdf_path)
-        page = doc.load_page(page_num - 1)
-        rect = fitz.Rect(rect_coords)
-        
-        # Increase the DPI for higher resolution
-        matrix = fitz.Matrix(3, 3) 
-        pixmap = page.get_pixmap(matrix=matrix, clip=rect)
-        
-        # Save the pixmap to a temporary file
-        temp_image_path = tempfile.mktemp(suffix=".png", dir=app.config['UPLOAD_FOLDER'])
-        pixmap.save(temp_image_path)
+        if app.config['DOCX_IMAGE_GRAYSCALE'] and pixmap.colorspace.n != 1:
+            pixmap = fitz.Pixmap(fitz.csGRAY, pixmap)
+
+        # Keep the encoded image in memory instead of a temporary file on disk
+        if app.config['DOCX_IMAGE_FORMAT'] == 'jpeg':
+            # JPEG has no alpha channel
+            if pixmap.alpha:
+                pixmap = fitz.Pixmap(pixmap, 0)
+            image_bytes = pixmap.pil_tobytes(format="JPEG", quality=app.config['DOCX_IMAGE_JPEG_QUALITY'])
+        else:
+            image_bytes = pixmap.tobytes("png")
+        image_buffer = io.BytesIO(image_bytes)
         
-        doc.close()
-        logging.info(f"Created temporary image for highlight: {temp_image_path}")
-        return temp_image_path
+        logging.info(f"Created in-memory image for highlight on page {page_num}")
+        return image_buffer
     except Exception as e:
         logging.exception(f"Error creating image for highlight: {e}")
         return None
 
 # --- Modified Function to Generate DOCX from Highlights ---
-def generate_docx_from_highlights(original_pdf_path, highlights, output_docx_path):
+def generate_docx_from_highlights(records, output_docx_path):
     """
-    Generates a new DOCX file containing all extracted highlights.
+    Generates a new DOCX file containing all extracted highlights, from the
+    (highlight, is_complex, image_pixmap) triples gathered by collect_docx_records.
     If the text is complex, it inserts an image of the highlight.
     Otherwise, it inserts the text.
     """
     document = Document()
     document.add_heading('Extracted PDF Highlights', level=1)
     
-    if not highlights:
+    if not records:
         document.add_paragraph("No highlights found in the document.")
     else:
-        for highlight in highlights:
+        sanitized_texts = [sanitize_text(highlight['text']) for highlight, _, _ in records]
+
+        # Encode all complex-text highlight images in one pass before building the document.
+        # Repeated highlights (same page and rect) share one encoded image; python-docx then also
+        # embeds identical images only once.
+        highlight_images = {}
+        encoded_images = {}
+        for index, (highlight, is_complex, image_pixmap) in enumerate(records):
+            if is_complex:
+                image_key = (highlight['page'], tuple(highlight['rect']))
+                if image_key not in encoded_images:
+                    logging.info(f"Complex text detected. Generating image for highlight on page {highlight['page']}.")
+                    encoded_images[image_key] = (create_highlight_image(image_pixmap, highlight['page'])
+                                                 if image_pixmap is not None else None)
+                highlight_images[index] = encoded_images[image_key]
+
+        for index, ((highlight, _, _), sanitized_text) in enumerate(zip(records, sanitized_texts)):
             # Add a paragraph with the page number
             page_paragraph = document.add_paragraph()
             page_paragraph.add_run(f"Page {highlight['page']}:").bold = True
             
             # --- MODIFIED LOGIC ---
             text_paragraph = document.add_paragraph()
-            sanitized_text = sanitize_text(highlight['text'])
             
-            if is_complex_text(sanitized_text):
-                logging.info(f"Complex text detected. Generating image for highlight on page {highlight['page']}.")
-                image_path = create_highlight_image(original_pdf_path, highlight['page'], highlight['rect'])
-                if image_path and os.path.exists(image_path):
+            if index in highlight_images:
+                image_buffer = highlight_images[index]
+                if image_buffer:
                     try:
                         # Insert the image into the DOCX
-                        document.add_picture(image_path, width=Inches(6)) # Adjust width as needed
+                        document.add_picture(image_buffer, width=Inches(app.config['DOCX_IMAGE_WIDTH_INCHES'])) # Adjust width as needed
                         logging.info("Successfully inserted image into DOCX.")
                     except Exception as e:
                         logging.error(f"Failed to insert image into DOCX: {e}")
                         text_paragraph.add_run(f"[[Image not available for complex text on Page {highlight['page']}]]")
-                    finally:
-                        # Clean up the temporary image file
-                        os.remove(image_path)
-                        logging.info(f"Cleaned up temporary image file: {image_path}")
                 else:
                     logging.warning("Image creation failed, inserting sanitized text as fallback.")
                     text_paragraph.add_run(sanitized_text)
@@ -299,15 +485,26 @@ def upload_pdf():
         return jsonify({"error": "Invalid file type. Please upload a PDF document."}), 400
 
     if file:
+        remove_stale_generated_files()
         temp_input_pdf_path = None
+        original_doc = None
+        records = None
         output_pdf_path = None
         output_docx_path = None
         
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=app.config['UPLOAD_FOLDER']) as temp_input_pdf:
-                file.save(temp_input_pdf.name)
-                temp_input_pdf_path = temp_input_pdf.name
-            logging.info(f"Uploaded PDF saved temporarily to: {temp_input_pdf_path}")
+            # Open small uploads straight from memory; only large (or unsized) uploads go through disk
+            content_length = request.content_length
+            if content_length is not None and content_length <= app.config['IN_MEMORY_UPLOAD_LIMIT']:
+                original_doc = fitz.open(stream=file.stream.read(), filetype="pdf")
+                logging.info(f"Opened uploaded PDF from memory ({content_length} bytes)")
+            else:
+                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=app.config['UPLOAD_FOLDER']) as temp_input_pdf:
+                    # Copy the upload in 1 MiB chunks so large files never sit fully in memory
+                    shutil.copyfileobj(file.stream, temp_input_pdf, length=1 << 20)
+                    temp_input_pdf_path = temp_input_pdf.name
+                logging.info(f"Uploaded PDF saved temporarily to: {temp_input_pdf_path}")
+                original_doc = fitz.open(temp_input_pdf_path)
 
             original_filename_base = os.path.splitext(file.filename)[0]
             
@@ -315,14 +512,18 @@ def upload_pdf():
             output_pdf_id = uuid.uuid4().hex
             output_filename = f"highlights_{original_filename_base}_{output_pdf_id}.pdf"
             output_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-            extracted_highlights = extract_highlights_from_pdf(temp_input_pdf_path)
-            generate_pdf_from_highlight_screenshots(temp_input_pdf_path, extracted_highlights, output_pdf_path, extraction_mode)
-            
+            # The single page walk streams straight into the PDF writer, so rendered pages are laid out
+            # as they are produced; only the highlights and their complex-text images are kept for the DOCX
+            records = []
+            generate_pdf_from_highlight_screenshots(collect_docx_records(process_pdf(original_doc, extraction_mode), records),
+                                                    output_pdf_path, extraction_mode)
+            extracted_highlights = [highlight for highlight, _, _ in records]
+
             # --- Process and generate DOCX output ---
             output_docx_id = uuid.uuid4().hex
             output_docx_filename = f"highlights_text_{original_filename_base}_{output_docx_id}.docx"
             output_docx_path = os.path.join(app.config['UPLOAD_FOLDER'], output_docx_filename)
-            generate_docx_from_highlights(temp_input_pdf_path, extracted_highlights, output_docx_path)
+            generate_docx_from_highlights(records, output_docx_path)
 
             pdf_download_url = f"/download-pdf/{output_filename}"
             docx_download_url = f"/download-docx/{output_docx_filename}"
@@ -340,35 +541,83 @@ def upload_pdf():
             logging.exception("An error occurred during PDF processing and generation.")
             return jsonify({"error": "Failed to process PDF. Please try again."}), 500
         finally:
-            if temp_input_pdf_path and os.path.exists(temp_input_pdf_path):
-                os.remove(temp_input_pdf_path)
-                logging.info(f"Cleaned up input PDF: {temp_input_pdf_path}")
-            pass
+            if original_doc is not None:
+                original_doc.close()
+            # Drop the document and pixmaps, then empty MuPDF's internal store (fonts, images, ...),
+            # which otherwise keeps the memory of the largest PDF seen so far in this worker.
+            original_doc = None
+            records = None
+            fitz.TOOLS.store_shrink(100)
+            mupdf_warnings = fitz.TOOLS.mupdf_warnings(reset=True)
+            if mupdf_warnings:
+                logging.warning(f"MuPDF reported warnings while processing the PDF:\n{mupdf_warnings}")
+            if temp_input_pdf_path:
+                try:
+                    os.remove(temp_input_pdf_path)
+                    logging.info(f"Cleaned up input PDF: {temp_input_pdf_path}")
+                except FileNotFoundError:
+                    pass
 
     logging.error("An unexpected flow occurred in /upload-pdf.")
     return jsonify({"error": "An unexpected error occurred"}), 500
 
+# --- Generated File Helpers ---
+GENERATED_FILE_PREFIX = "highlights_"
+
+def take_generated_file(filename, extension):
+    """
+    Opens a generated output file for its one-time download and removes it from disk straight away.
+    The open handle keeps the contents readable while the response streams, so nothing is left
+    behind whether or not the client finishes the download. Returns None if there is no such file,
+    or if it is not of the extension the calling endpoint serves (so /download-pdf can't consume a DOCX).
+    """
+    if not filename.startswith(GENERATED_FILE_PREFIX) or not filename.lower().endswith(extension):
+        return None
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if file_path is None:
+        return None
+    try:
+        generated_file = open(file_path, 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass # A concurrent request for the same file removed it first
+    logging.info(f"Removed generated file from disk, streaming it to the client: {file_path}")
+    return generated_file
+
+def remove_stale_generated_files():
+    """
+    Deletes generated files that were never downloaded within OUTPUT_FILE_TTL seconds.
+    """
+    cutoff = time.time() - app.config['OUTPUT_FILE_TTL']
+    try:
+        with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+            for entry in entries:
+                if entry.name.startswith(GENERATED_FILE_PREFIX) and entry.is_file() and entry.stat().st_mtime < cutoff:
+                    try:
+                        os.remove(entry.path)
+                        logging.info(f"Removed stale generated file: {entry.path}")
+                    except FileNotFoundError:
+                        pass
+    except OSError as e:
+        logging.warning(f"Could not clean up stale generated files: {e}")
+
 # --- New Endpoint to Serve Generated PDF ---
 @app.route('/download-pdf/<filename>', methods=['GET'])
 def download_pdf(filename):
     logging.info(f"Received request to download PDF: {filename}")
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    generated_file = take_generated_file(filename, '.pdf')
 
-    if not os.path.exists(file_path):
-        logging.warning(f"Requested file not found: {file_path}")
+    if generated_file is None:
+        logging.warning(f"Requested file not found: {filename}")
         return jsonify({"error": "File not found."}), 404
 
     try:
-        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True, mimetype='application/pdf')
-        
-        @response.call_on_close
-        def cleanup():
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logging.info(f"Cleaned up output PDF after download: {file_path}")
-        
-        return response
+        return send_file(generated_file, mimetype='application/pdf', as_attachment=True, download_name=filename)
     except Exception as e:
+        generated_file.close()
         logging.exception(f"Error serving download file {filename}.")
         return jsonify({"error": "Could not serve the requested file."}), 500
 
@@ -376,23 +625,16 @@ def download_pdf(filename):
 @app.route('/download-docx/<filename>', methods=['GET'])
 def download_docx(filename):
     logging.info(f"Received request to download DOCX: {filename}")
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    generated_file = take_generated_file(filename, '.docx')
     
-    if not os.path.exists(file_path):
-        logging.warning(f"Requested file not found: {file_path}")
+    if generated_file is None:
+        logging.warning(f"Requested file not found: {filename}")
         return jsonify({"error": "File not found."}), 404
     
     try:
-        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-
-        @response.call_on_close
-        def cleanup():
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logging.info(f"Cleaned up output DOCX after download: {file_path}")
-        
-        return response
+        return send_file(generated_file, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', as_attachment=True, download_name=filename)
     except Exception as e:
+        generated_file.close()
         logging.exception(f"Error serving download DOCX file {filename}.")
         return jsonify({"error": "Could not serve the requested file."}), 500
 
@@ -405,5 +647,13 @@ if __name__ == '__main__':
     static_dir = os.path.join(app.root_path, 'static')
     os.makedirs(static_dir, exist_ok=True)
     logging.info(f"Static directory for frontend: {static_dir}")
-    port = int(os.environ.get("PORT", 8000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    if os.environ.get("FLASK_DEV") == "1":
+        # Single-process development server, for local testing only
+        port = int(os.environ.get("PORT", 8000))
+        app.run(host='0.0.0.0', port=port, debug=False)
+    else:
+        # Production: hand over to Gunicorn (settings in gunicorn.conf.py)
+        logging.info("Starting Gunicorn. Set FLASK_DEV=1 to use the Flask development server instead.")
+        # Pin the app directory and config file so this works from any working directory
+        os.execvp("gunicorn", ["gunicorn", "--chdir", app.root_path,
+                               "-c", os.path.join(app.root_path, "gunicorn.conf.py"), "app:app"])
\ No newline at end of file
@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+# Production server settings. Gunicorn reads this file automatically when started from the
+# project root, so the Procfile / render.yaml command `gunicorn app:app` picks it up:
+#
+#   gunicorn app:app
+#
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# PDF rendering is CPU-bound, so scale with processes: one worker per core this process may run on
+# (the host's CPU count overstates that in containers), capped because every worker holds a large
+# PDF's renders in memory. Small instances should set WEB_CONCURRENCY to what their memory allows.
+# Workers are single-threaded (sync) because PyMuPDF does not support using documents from
+# multiple threads.
+MAX_DEFAULT_WORKERS = 4
+usable_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+workers = int(os.environ.get('WEB_CONCURRENCY', min(usable_cpus, MAX_DEFAULT_WORKERS)))
+worker_class = 'sync'
+
+# Import the app (and load the MuPDF shared library) once in the master, then fork the workers.
+preload_app = True
+
+# Large PDFs can take a while to render; don't let the default 30s timeout kill those requests.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+accesslog = '-'
+errorlog = '-'